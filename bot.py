@@ -3,14 +3,30 @@ YouTube Audio Drive Bot
 A Telegram bot that converts YouTube videos to audio and uploads to Google Drive.
 """
 
+import io
 import os
+import hmac
+import secrets
+import signal
+import asyncio
+import time
+import shutil
 import logging
+import weakref
+import tempfile
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from aiohttp import web
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
-from services.youtube_service import download_audio, is_youtube_url
-from services.drive_service import upload_to_drive
+from services.youtube_service import extract_video_id, fetch_audio, is_youtube_url, probe_video
+from services.drive_service import (
+    close_drive_service, find_in_drive, upload_to_drive, upload_stream_to_drive
+)
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +43,35 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 GOOGLE_DRIVE_FOLDER_ID = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
 CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
 
+# Telegram bot API upload limit
+TELEGRAM_MAX_MB = 50
+
+# Public HTTPS URL of the service; enables webhook mode when set
+PUBLIC_URL = os.getenv('PUBLIC_URL')
+PORT = int(os.getenv('PORT', 8000))
+
+# Working directory for downloaded audio, created once at startup
+DOWNLOAD_DIR = Path("downloads")
+
+# Leftover files older than this are swept from DOWNLOAD_DIR periodically
+CLEANUP_INTERVAL = 600  # seconds
+MAX_FILE_AGE = 1800  # seconds
+
+# Max threads for blocking work (file I/O)
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 4))
+
+# Max download/upload jobs running at once across all chats
+MAX_JOBS = int(os.getenv('MAX_JOBS', 2))
+JOB_SEMAPHORE = asyncio.Semaphore(MAX_JOBS)
+
+# Per-chat locks; weak values, so a lock is dropped once no job holds or awaits it
+CHAT_LOCKS = weakref.WeakValueDictionary()
+
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    """Return the lock that serializes jobs within one chat."""
+    return CHAT_LOCKS.setdefault(chat_id, asyncio.Lock())
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /start command."""
@@ -80,90 +125,129 @@ async def handle_youtube_link(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_youtube_url(url):
         return
     
+    # Playlist-only links (watch?list=... without v=) would make yt-dlp
+    # download every entry of the playlist
+    if not extract_video_id(url):
+        await update.message.reply_text(
+            "❌ أرسل رابط فيديو واحد، روابط قوائم التشغيل غير مدعومة."
+        )
+        return
+    
     # Send processing message
     processing_msg = await update.message.reply_text(
         "⏳ جاري تحميل وتحويل الفيديو... انتظر قليلاً"
     )
     
-    try:
-        # Download and convert audio
-        file_path, result = download_audio(url, "downloads")
-        
-        if file_path is None:
-            await processing_msg.edit_text(f"❌ فشل التحميل: {result}")
-            return
-        
-        # Update status
-        await processing_msg.edit_text("📤 جاري إرسال الملف...")
-        
-        # Check file size (Telegram limit is 50MB)
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        telegram_sent = False
-        
-        if file_size_mb <= 50:
-            # Send audio file to user
-            try:
-                with open(file_path, 'rb') as audio_file:
-                    await update.message.reply_audio(
-                        audio=audio_file,
-                        title=result,
-                        caption=f"🎵 {result}"
+    # One job per chat at a time, and a global cap on concurrent jobs
+    async with chat_lock(update.effective_chat.id), JOB_SEMAPHORE:
+        job_dir = None
+        active_dirs = context.bot_data['active_job_dirs']
+        try:
+            # Without Drive, oversized audio can't be delivered at all: estimate
+            # the MP3 size first instead of spending a full download and encode
+            if not GOOGLE_DRIVE_FOLDER_ID:
+                loop = asyncio.get_running_loop()
+                _, _, approx_mb = await run_with_download_pool(
+                    context.application,
+                    lambda pool: loop.run_in_executor(pool, probe_video, url)
+                )
+                if approx_mb and approx_mb > TELEGRAM_MAX_MB:
+                    await processing_msg.edit_text(
+                        f"❌ الملف كبير جداً (~{approx_mb:.1f}MB)\n"
+                        "أضف إعدادات Drive لرفع الملفات الكبيرة."
                     )
-                telegram_sent = True
-            except Exception as send_error:
-                logger.warning(f"Failed to send via Telegram: {send_error}")
-        else:
-            await processing_msg.edit_text(
-                f"⚠️ الملف كبير ({file_size_mb:.1f}MB)، سيتم رفعه للدرايف فقط..."
-            )
-        
-        # Upload to Google Drive if configured
-        if GOOGLE_DRIVE_FOLDER_ID:
-            await processing_msg.edit_text("☁️ جاري الرفع إلى Google Drive...")
+                    return
             
-            file_id = upload_to_drive(
-                file_path,
-                GOOGLE_DRIVE_FOLDER_ID,
-                CREDENTIALS_PATH
+            # Download and convert audio in a directory of its own, so
+            # concurrent jobs for the same video or title never share files
+            job_dir = await asyncio.to_thread(tempfile.mkdtemp, dir=DOWNLOAD_DIR)
+            active_dirs.add(os.path.abspath(job_dir))
+            file_path, result, video_id = await run_with_download_pool(
+                context.application,
+                lambda pool: fetch_audio(url, job_dir, pool)
             )
             
-            if file_id:
-                drive_link = f"https://drive.google.com/file/d/{file_id}/view"
-                if telegram_sent:
-                    await processing_msg.edit_text(
-                        "✅ تم بنجاح!\n"
-                        "• الملف مرسل إليك\n"
-                        f"• [رابط Drive]({drive_link})"
-                    , parse_mode='Markdown')
-                else:
-                    await processing_msg.edit_text(
-                        f"✅ تم الرفع للدرايف!\n"
-                        f"📁 الملف كبير ({file_size_mb:.1f}MB)\n"
-                        f"🔗 [اضغط هنا للتحميل]({drive_link})"
-                    , parse_mode='Markdown')
+            if file_path is None:
+                await processing_msg.edit_text(f"❌ فشل التحميل: {result}")
+                return
+            
+            # Update status
+            await processing_msg.edit_text("📤 جاري إرسال الملف...")
+            
+            # Check file size (Telegram limit is 50MB)
+            file_size = await asyncio.to_thread(os.path.getsize, file_path)
+            file_size_mb = file_size / (1024 * 1024)
+            telegram_sent = False
+            
+            if file_size_mb <= TELEGRAM_MAX_MB:
+                # Send audio file to user
+                try:
+                    # Read off the event loop; PTB would read the handle synchronously
+                    audio_data = await asyncio.to_thread(Path(file_path).read_bytes)
+                    await update.message.reply_audio(
+                        audio=audio_data,
+                        filename=os.path.basename(file_path),
+                        title=result,
+                        caption=f"🎵 {result}"
+                    )
+                    telegram_sent = True
+                except Exception as send_error:
+                    logger.warning(f"Failed to send via Telegram: {send_error}")
             else:
                 await processing_msg.edit_text(
-                    "✅ تم إرسال الملف!\n" if telegram_sent else "❌ فشل الرفع!\n"
-                    "⚠️ فشل الرفع إلى Drive (تحقق من الإعدادات)"
+                    f"⚠️ الملف كبير ({file_size_mb:.1f}MB)، سيتم رفعه للدرايف فقط..."
                 )
-        else:
-            if telegram_sent:
-                await processing_msg.edit_text("✅ تم إرسال الملف بنجاح!")
-            else:
-                await processing_msg.edit_text(
-                    f"❌ الملف كبير جداً ({file_size_mb:.1f}MB)\n"
-                    "أضف إعدادات Drive لرفع الملفات الكبيرة."
+            
+            # Upload to Google Drive if configured
+            if GOOGLE_DRIVE_FOLDER_ID:
+                await processing_msg.edit_text("☁️ جاري الرفع إلى Google Drive...")
+                
+                file_id = await upload_to_drive(
+                    file_path,
+                    GOOGLE_DRIVE_FOLDER_ID,
+                    CREDENTIALS_PATH,
+                    f"yt:{video_id}" if video_id else None
                 )
-        
-        # Cleanup: remove local file
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            logger.warning(f"Failed to remove temp file: {e}")
+                
+                if file_id:
+                    drive_link = f"https://drive.google.com/file/d/{file_id}/view"
+                    if telegram_sent:
+                        await processing_msg.edit_text(
+                            "✅ تم بنجاح!\n"
+                            "• الملف مرسل إليك\n"
+                            f"• [رابط Drive]({drive_link})"
+                        , parse_mode='Markdown')
+                    else:
+                        await processing_msg.edit_text(
+                            f"✅ تم الرفع للدرايف!\n"
+                            f"📁 الملف كبير ({file_size_mb:.1f}MB)\n"
+                            f"🔗 [اضغط هنا للتحميل]({drive_link})"
+                        , parse_mode='Markdown')
+                else:
+                    await processing_msg.edit_text(
+                        "✅ تم إرسال الملف!\n" if telegram_sent else "❌ فشل الرفع!\n"
+                        "⚠️ فشل الرفع إلى Drive (تحقق من الإعدادات)"
+                    )
+            else:
+                if telegram_sent:
+                    await processing_msg.edit_text("✅ تم إرسال الملف بنجاح!")
+                else:
+                    await processing_msg.edit_text(
+                        f"❌ الملف كبير جداً ({file_size_mb:.1f}MB)\n"
+                        "أضف إعدادات Drive لرفع الملفات الكبيرة."
+                    )
             
-    except Exception as e:
-        logger.error(f"Error processing URL: {e}")
-        await processing_msg.edit_text(f"❌ حدث خطأ: {str(e)}")
+        except Exception as e:
+            logger.error(f"Error processing URL: {e}")
+            await processing_msg.edit_text(f"❌ حدث خطأ: {str(e)}")
+        finally:
+            # Cleanup: remove the job's files, even if sending or uploading failed
+            if job_dir:
+                try:
+                    await asyncio.to_thread(shutil.rmtree, job_dir)
+                except Exception as e:
+                    logger.warning(f"Failed to remove temp directory: {e}")
+                active_dirs.discard(os.path.abspath(job_dir))
 
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -182,52 +266,61 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         f"📦 الحجم: {file_size_mb:.1f}MB"
     )
     
-    try:
-        # Download file from Telegram
-        file = await context.bot.get_file(document.file_id)
-        
-        # Create downloads directory
-        os.makedirs("downloads", exist_ok=True)
-        local_path = os.path.join("downloads", file_name)
-        
-        await file.download_to_drive(local_path)
-        
-        await processing_msg.edit_text("☁️ جاري الرفع إلى Google Drive...")
-        
-        # Upload to Drive
-        if GOOGLE_DRIVE_FOLDER_ID:
-            file_id = upload_to_drive(
-                local_path,
-                GOOGLE_DRIVE_FOLDER_ID,
-                CREDENTIALS_PATH
-            )
+    # One job per chat at a time, and a global cap on concurrent jobs
+    async with chat_lock(update.effective_chat.id), JOB_SEMAPHORE:
+        try:
+            # Already in Drive from an earlier upload: skip the Telegram download
+            if GOOGLE_DRIVE_FOLDER_ID:
+                existing_id = await find_in_drive(
+                    f"tg:{document.file_unique_id}", GOOGLE_DRIVE_FOLDER_ID, CREDENTIALS_PATH
+                )
+                if existing_id:
+                    drive_link = f"https://drive.google.com/file/d/{existing_id}/view"
+                    await processing_msg.edit_text(
+                        f"♻️ الملف مرفوع مسبقاً!\n"
+                        f"📚 {file_name}\n"
+                        f"🔗 [رابط Drive]({drive_link})"
+                    , parse_mode='Markdown')
+                    return
             
-            if file_id:
-                drive_link = f"https://drive.google.com/file/d/{file_id}/view"
-                await processing_msg.edit_text(
-                    f"✅ تم رفع الملف بنجاح!\n"
-                    f"📚 {file_name}\n"
-                    f"🔗 [رابط Drive]({drive_link})"
-                , parse_mode='Markdown')
+            # Download file from Telegram straight into memory
+            file = await context.bot.get_file(document.file_id)
+            buffer = io.BytesIO()
+            await file.download_to_memory(buffer)
+            
+            await processing_msg.edit_text("☁️ جاري الرفع إلى Google Drive...")
+            
+            # Upload to Drive
+            if GOOGLE_DRIVE_FOLDER_ID:
+                file_id = await upload_stream_to_drive(
+                    buffer,
+                    file_name,
+                    GOOGLE_DRIVE_FOLDER_ID,
+                    CREDENTIALS_PATH,
+                    f"tg:{document.file_unique_id}",
+                    check_duplicate=False  # Looked up above
+                )
+                
+                if file_id:
+                    drive_link = f"https://drive.google.com/file/d/{file_id}/view"
+                    await processing_msg.edit_text(
+                        f"✅ تم رفع الملف بنجاح!\n"
+                        f"📚 {file_name}\n"
+                        f"🔗 [رابط Drive]({drive_link})"
+                    , parse_mode='Markdown')
+                else:
+                    await processing_msg.edit_text(
+                        "❌ فشل الرفع إلى Drive\n"
+                        "تحقق من إعدادات الاتصال."
+                    )
             else:
                 await processing_msg.edit_text(
-                    "❌ فشل الرفع إلى Drive\n"
-                    "تحقق من إعدادات الاتصال."
+                    "⚠️ Drive غير مفعّل. أضف GOOGLE_DRIVE_FOLDER_ID"
                 )
-        else:
-            await processing_msg.edit_text(
-                "⚠️ Drive غير مفعّل. أضف GOOGLE_DRIVE_FOLDER_ID"
-            )
-        
-        # Cleanup
-        try:
-            os.remove(local_path)
-        except:
-            pass
-            
-    except Exception as e:
-        logger.error(f"Error uploading document: {e}")
-        await processing_msg.edit_text(f"❌ حدث خطأ: {str(e)}")
+                
+        except Exception as e:
+            logger.error(f"Error uploading document: {e}")
+            await processing_msg.edit_text(f"❌ حدث خطأ: {str(e)}")
 
 
 async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -238,6 +331,170 @@ async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
 
+def sweep_downloads(active_dirs: frozenset) -> None:
+    """
+    Delete stale files and job directories (failed jobs, .part files) from
+    DOWNLOAD_DIR, skipping directories of jobs still running.
+    """
+    cutoff = time.time() - MAX_FILE_AGE
+    for path in DOWNLOAD_DIR.iterdir():
+        try:
+            # A directory's mtime doesn't change while its files are written,
+            # so a long job's directory would otherwise look stale
+            if os.path.abspath(path) in active_dirs or path.stat().st_mtime >= cutoff:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+            logger.info(f"Removed stale file: {path.name}")
+        except OSError as e:
+            logger.warning(f"Failed to remove stale file {path.name}: {e}")
+
+
+async def cleanup_downloads(application: Application) -> None:
+    """Periodically sweep DOWNLOAD_DIR so leaked files can't fill the disk."""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        try:
+            active_dirs = frozenset(application.bot_data['active_job_dirs'])
+            await asyncio.to_thread(sweep_downloads, active_dirs)
+        except Exception as e:
+            logger.warning(f"Download cleanup failed: {e}")
+
+
+async def health(request: web.Request) -> web.Response:
+    """Respond to Koyeb health checks."""
+    return web.Response(text='OK')
+
+
+async def start_web_server(application: Application) -> web.AppRunner:
+    """
+    Serve health checks, and Telegram webhook updates when PUBLIC_URL is
+    set, from one aiohttp app on the bot's event loop.
+    """
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        # Only Telegram knows the secret passed to set_webhook
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, application.bot_data['webhook_secret']):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        update = Update.de_json(data, application.bot)
+        await application.update_queue.put(update)
+        return web.Response()
+    
+    app = web.Application()
+    app.router.add_get('/', health)
+    app.router.add_get('/health', health)
+    if PUBLIC_URL:
+        app.router.add_post(f'/{TELEGRAM_BOT_TOKEN}', telegram_webhook)
+    
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    print(f"🌐 Web server running on port {PORT}")
+    return runner
+
+
+def new_download_pool() -> ProcessPoolExecutor:
+    """Create the process pool that runs yt-dlp."""
+    # yt-dlp's extraction is pure Python; separate processes run it on all cores.
+    # No more workers than JOB_SEMAPHORE lets run; each one re-imports bot.py.
+    # 'spawn' because forking a process with running threads is unsafe.
+    return ProcessPoolExecutor(
+        max_workers=min(MAX_JOBS, os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+
+async def run_with_download_pool(application: Application, call):
+    """
+    Await call(pool) with the download pool, retrying once on a fresh pool
+    if a worker died (e.g. OOM-killed) and left the pool broken.
+    """
+    pool = application.bot_data.get('download_pool')
+    try:
+        return await call(pool)
+    except BrokenProcessPool:
+        # Concurrent jobs may hit the same broken pool; replace it only once
+        if application.bot_data.get('download_pool') is pool:
+            logger.warning("Download pool broken, starting a new one")
+            application.bot_data['download_pool'] = new_download_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return await call(application.bot_data['download_pool'])
+
+
+async def post_init(application: Application) -> None:
+    """Set up the event loop once the application is initialized."""
+    # Bounded pool for blocking calls (file I/O)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    
+    application.bot_data['download_pool'] = new_download_pool()
+    
+    # Job directories in use, which the sweeper must leave alone
+    application.bot_data['active_job_dirs'] = set()
+    application.bot_data['cleanup_task'] = asyncio.create_task(cleanup_downloads(application))
+    
+    application.bot_data['web_runner'] = await start_web_server(application)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background tasks, worker pools and shared HTTP sessions."""
+    cleanup_task = application.bot_data.pop('cleanup_task', None)
+    if cleanup_task:
+        cleanup_task.cancel()
+    
+    web_runner = application.bot_data.pop('web_runner', None)
+    if web_runner:
+        await web_runner.cleanup()
+    
+    download_pool = application.bot_data.pop('download_pool', None)
+    if download_pool:
+        download_pool.shutdown(cancel_futures=True)
+    
+    await close_drive_service()
+
+
+async def run_webhook(application: Application) -> None:
+    """
+    Run the bot with Telegram pushing updates to our aiohttp server.
+    
+    PTB's run_webhook serves only the webhook path, so the application is
+    driven manually here and the shared web server also answers health checks.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C still cancels asyncio.run()
+    
+    # Fresh per run; Telegram echoes it in a header on every webhook request
+    application.bot_data['webhook_secret'] = secrets.token_urlsafe(32)
+    
+    async with application:
+        await post_init(application)
+        try:
+            await application.bot.set_webhook(
+                url=f"{PUBLIC_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+                allowed_updates=[Update.MESSAGE],
+                secret_token=application.bot_data['webhook_secret'],
+            )
+            await application.start()
+            await stop_event.wait()
+        finally:
+            if application.running:
+                await application.stop()
+            await post_shutdown(application)
+
+
 def main() -> None:
     """Run the bot."""
     # Validate configuration
@@ -247,9 +504,19 @@ def main() -> None:
         return
     
     print("🚀 Starting YouTube Audio Drive Bot...")
+    DOWNLOAD_DIR.mkdir(exist_ok=True)
     
-    # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Create application; in webhook mode updates arrive via our web server
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(True)
+    )
+    if PUBLIC_URL:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -267,31 +534,11 @@ def main() -> None:
     
     # Start the bot
     print("✅ Bot is running! Press Ctrl+C to stop.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-
-def start_health_server():
-    """Start a simple HTTP server for Koyeb health checks."""
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    import threading
-    
-    class HealthHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
-        
-        def log_message(self, format, *args):
-            pass  # Suppress logging
-    
-    port = int(os.getenv('PORT', 8000))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
-    thread = threading.Thread(target=server.serve_forever, daemon=True)
-    thread.start()
-    print(f"🌐 Health server running on port {port}")
+    if PUBLIC_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=[Update.MESSAGE])
 
 
 if __name__ == '__main__':
-    start_health_server()
     main()
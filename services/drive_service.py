@@ -4,36 +4,104 @@ Uploads files to Google Drive using OAuth 2.0 authentication.
 """
 
 import os
+import random
 import pickle
-from typing import Optional
+import asyncio
+import mimetypes
+import aiohttp
+from typing import IO, Optional, Union
+from aiogoogle import Aiogoogle, HTTPError
+from aiogoogle.auth.creds import ClientCreds, UserCreds
+from aiogoogle.resource import GoogleAPI
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
 
 
 # Scopes required for Drive API
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
-TOKEN_PATH = 'token.pickle'
+TOKEN_PATH = 'token.json'
+LEGACY_TOKEN_PATH = 'token.pickle'
 
+# Transient statuses worth retrying (403 only for rate-limit reasons)
+RETRY_CODES = {403, 429, 500, 502, 503, 504}
+MAX_BACKOFF = 64
 
-def get_drive_service(credentials_path: str = "oauth_credentials.json"):
+# No total limit, so large uploads over slow links aren't cut off after
+# aiohttp's default 300s; a stalled connection still fails on sock_read
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+# Cached discovery document and client, created on first use
+_drive = None
+_client = None
+_lock = asyncio.Lock()
+
+
+class _PersistentAiogoogle(Aiogoogle):
+    """
+    Aiogoogle client that sends every request over one long-lived aiohttp
+    session, so TLS connections to the Drive API are kept alive across calls.
+    
+    Aiogoogle's own context manager keeps the session in a ContextVar, which
+    isn't visible from other handler tasks.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shared_session = None
+    
+    async def send(self, *args, **kwargs):
+        if self._shared_session is None:
+            self._shared_session = self.session_factory(timeout=HTTP_TIMEOUT)
+        return await self._shared_session.send(*args, **kwargs)
+    
+    async def close(self) -> None:
+        if self._shared_session is not None:
+            await self._shared_session.close()
+            self._shared_session = None
+
+
+def _save_token(creds: Credentials) -> None:
+    """Persist OAuth credentials as JSON."""
+    with open(TOKEN_PATH, 'w') as token:
+        token.write(creds.to_json())
+
+
+def _load_token() -> Optional[Credentials]:
+    """
+    Load saved OAuth credentials.
+    
+    A token.pickle left by older versions is converted to token.json once,
+    so existing deployments keep working without re-authenticating.
+    
+    Returns:
+        The saved credentials, or None if no token exists
+    """
+    if os.path.exists(TOKEN_PATH):
+        return Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+    
+    if os.path.exists(LEGACY_TOKEN_PATH):
+        with open(LEGACY_TOKEN_PATH, 'rb') as token:
+            creds = pickle.load(token)
+        _save_token(creds)
+        print(f"🔁 Migrated {LEGACY_TOKEN_PATH} to {TOKEN_PATH}")
+        return creds
+    
+    return None
+
+
+def load_credentials(credentials_path: str = "oauth_credentials.json") -> Optional[Credentials]:
     """
-    Create and return a Google Drive service object using OAuth 2.0.
+    Load OAuth 2.0 credentials, refreshing or authenticating as needed.
     
     Args:
         credentials_path: Path to the OAuth credentials JSON file
-        
+    
     Returns:
-        Google Drive service object
+        Valid credentials, or None if no OAuth credentials file exists
     """
-    creds = None
-    
     # Load existing token if available
-    if os.path.exists(TOKEN_PATH):
-        with open(TOKEN_PATH, 'rb') as token:
-            creds = pickle.load(token)
+    creds = _load_token()
     
     # If no valid credentials, authenticate
     if not creds or not creds.valid:
@@ -49,69 +117,220 @@ def get_drive_service(credentials_path: str = "oauth_credentials.json"):
             creds = flow.run_local_server(port=0)
         
         # Save the credentials for future runs
-        with open(TOKEN_PATH, 'wb') as token:
-            pickle.dump(creds, token)
+        _save_token(creds)
     
-    return build('drive', 'v3', credentials=creds)
+    return creds
 
 
-def upload_to_drive(
-    file_path: str,
+async def get_drive_service(credentials_path: str = "oauth_credentials.json") -> Optional[GoogleAPI]:
+    """
+    Return the cached Google Drive API description using OAuth 2.0.
+    
+    Credentials are loaded and the discovery document fetched once;
+    expired access tokens are refreshed by aiogoogle on later requests.
+    
+    Args:
+        credentials_path: Path to the OAuth credentials JSON file
+    
+    Returns:
+        Google Drive API object, or None if credentials are missing
+    """
+    global _drive, _client
+    
+    async with _lock:
+        if _drive is not None:
+            return _drive
+        
+        creds = await asyncio.to_thread(load_credentials, credentials_path)
+        if creds is None:
+            return None
+        
+        client = _PersistentAiogoogle(
+            user_creds=UserCreds(
+                access_token=creds.token,
+                refresh_token=creds.refresh_token,
+                expires_at=creds.expiry.isoformat() if creds.expiry else None,
+                scopes=SCOPES
+            ),
+            client_creds=ClientCreds(
+                client_id=creds.client_id,
+                client_secret=creds.client_secret,
+                scopes=SCOPES
+            )
+        )
+        # Publish the client only once discovery works, so a failed attempt
+        # doesn't leave its session open for the next call to replace
+        try:
+            drive = await client.discover('drive', 'v3')
+        except BaseException:
+            await client.close()
+            raise
+        
+        _client, _drive = client, drive
+        return _drive
+
+
+async def close_drive_service() -> None:
+    """Close the shared Drive HTTP session (call on shutdown)."""
+    global _drive, _client
+    
+    async with _lock:
+        if _client is not None:
+            await _client.close()
+        _drive = None
+        _client = None
+
+
+def _is_retryable(error: HTTPError) -> bool:
+    """Check whether an HTTPError is a transient rate-limit or server error."""
+    if error.res is None:
+        return False
+    status = error.res.status_code
+    if status not in RETRY_CODES:
+        return False
+    if status == 403:
+        return 'ratelimitexceeded' in str(error.res.content).lower()
+    return True
+
+
+async def _send_with_retry(request, max_tries: int = 6):
+    """
+    Send a Drive API request over the shared session with exponential backoff.
+    
+    Args:
+        request: The aiogoogle Request to send (re-sent on retry)
+        max_tries: Maximum attempts
+    
+    Returns:
+        The API response content
+    """
+    tries = 0
+    while True:
+        try:
+            return await _client.as_user(request)
+        except HTTPError as e:
+            tries += 1
+            if tries >= max_tries or not _is_retryable(e):
+                raise
+            retry_after = (e.res.headers or {}).get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            else:
+                delay = 2 ** (tries - 1) + random.random()
+            delay = min(delay, MAX_BACKOFF)
+            print(f"⚠️ Drive API {e.res.status_code}, retrying in {delay:.1f}s...")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Dropped connections and timeouts are transient too
+            tries += 1
+            if tries >= max_tries:
+                raise
+            delay = min(2 ** (tries - 1) + random.random(), MAX_BACKOFF)
+            print(f"⚠️ Drive connection error ({type(e).__name__}), retrying in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+
+
+def _guess_mime_type(file_name: str) -> str:
+    """Determine MIME type based on file extension."""
+    mime_type, _ = mimetypes.guess_type(file_name)
+    return mime_type or 'application/octet-stream'
+
+
+def _escape_query(value: str) -> str:
+    """Escape a value for use inside a quoted Drive query string."""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+async def _find_duplicate(drive: GoogleAPI, dedup_key: str, folder_id: str) -> Optional[str]:
+    """Return the ID of a file already uploaded to the folder under dedup_key."""
+    query = (
+        f"appProperties has {{ key='dedup_key' and value='{_escape_query(dedup_key)}' }} "
+        f"and '{_escape_query(folder_id)}' in parents and trashed = false"
+    )
+    request = drive.files.list(q=query, fields='files(id)', pageSize=1)
+    files = (await _send_with_retry(request)).get('files', [])
+    return files[0]['id'] if files else None
+
+
+async def find_in_drive(
+    dedup_key: str,
     folder_id: str,
     credentials_path: str = "credentials.json"
 ) -> Optional[str]:
     """
-    Upload a file to Google Drive.
+    Look up a file previously uploaded to the folder under dedup_key.
     
     Args:
-        file_path: Path to the local file to upload
+        dedup_key: Content key the file was uploaded with
+        folder_id: Google Drive folder ID to search
+        credentials_path: Path to OAuth credentials
+    
+    Returns:
+        The file ID if found, None if not found or the lookup failed
+    """
+    try:
+        drive = await get_drive_service(credentials_path)
+        if drive is None:
+            return None
+        return await _find_duplicate(drive, dedup_key, folder_id)
+    except Exception as e:
+        print(f"❌ Error looking up file: {str(e)}")
+        return None
+
+
+async def _upload_media(
+    content: Union[str, bytes],
+    file_name: str,
+    folder_id: str,
+    credentials_path: str,
+    dedup_key: Optional[str] = None,
+    check_duplicate: bool = True
+) -> Optional[str]:
+    """
+    Create a Drive file from a local path or in-memory content.
+    
+    Args:
+        content: Path of the file to upload, or its bytes
+        file_name: Name of the file in Drive
         folder_id: Google Drive folder ID to upload to
         credentials_path: Path to OAuth credentials
-        
+        dedup_key: Content key; if a file with this key exists it is reused
+        check_duplicate: False if the caller already ran find_in_drive
+    
     Returns:
         The file ID if successful, None if failed
     """
     try:
-        service = get_drive_service(credentials_path)
-        if service is None:
+        drive = await get_drive_service(credentials_path)
+        if drive is None:
             return None
         
-        # Get file name from path
-        file_name = os.path.basename(file_path)
+        # Skip the upload entirely if this content is already in the folder
+        if dedup_key and check_duplicate:
+            existing_id = await _find_duplicate(drive, dedup_key, folder_id)
+            if existing_id:
+                print(f"♻️ Already uploaded: {file_name}")
+                return existing_id
         
         # File metadata
         file_metadata = {
             'name': file_name,
             'parents': [folder_id]
         }
+        if dedup_key:
+            file_metadata['appProperties'] = {'dedup_key': dedup_key}
         
-        # Determine MIME type based on file extension
-        import mimetypes
-        mime_type, _ = mimetypes.guess_type(file_name)
-        if mime_type is None:
-            mime_type = 'application/octet-stream'
-        
-        # Create media upload object
-        media = MediaFileUpload(
-            file_path,
-            mimetype=mime_type,
-            resumable=True,
-            chunksize=1024*1024  # 1MB chunks
-        )
-        
-        # Upload file
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
+        # Upload file; aiogoogle streams it as a single multipart request
+        request = drive.files.create(
+            upload_file=content,
+            json=file_metadata,
             fields='id, webViewLink'
-        ).execute()
+        )
+        request.upload_file_content_type = _guess_mime_type(file_name)
+        file = await _send_with_retry(request)
         
         print(f"✅ Uploaded: {file_name}")
         return file.get('id')
-        
-    except FileNotFoundError:
-        print(f"❌ File not found: {file_path}")
-        return None
+    
     except Exception as e:
         import traceback
         print(f"❌ Upload error: {str(e)}")
@@ -119,25 +338,81 @@ def upload_to_drive(
         return None
 
 
-def get_file_link(file_id: str, credentials_path: str = "credentials.json") -> Optional[str]:
+async def upload_to_drive(
+    file_path: str,
+    folder_id: str,
+    credentials_path: str = "credentials.json",
+    dedup_key: Optional[str] = None
+) -> Optional[str]:
+    """
+    Upload a file to Google Drive.
+    
+    Args:
+        file_path: Path to the local file to upload
+        folder_id: Google Drive folder ID to upload to
+        credentials_path: Path to OAuth credentials
+        dedup_key: Content key (e.g. YouTube video ID) used to skip duplicates
+    
+    Returns:
+        The file ID if successful, None if failed
+    """
+    if not os.path.exists(file_path):
+        print(f"❌ File not found: {file_path}")
+        return None
+    
+    return await _upload_media(
+        file_path, os.path.basename(file_path), folder_id, credentials_path, dedup_key
+    )
+
+
+async def upload_stream_to_drive(
+    stream: IO[bytes],
+    file_name: str,
+    folder_id: str,
+    credentials_path: str = "credentials.json",
+    dedup_key: Optional[str] = None,
+    check_duplicate: bool = True
+) -> Optional[str]:
+    """
+    Upload an in-memory file object to Google Drive without touching disk.
+    
+    Args:
+        stream: Seekable binary stream holding the content
+        file_name: Name of the file in Drive
+        folder_id: Google Drive folder ID to upload to
+        credentials_path: Path to OAuth credentials
+        dedup_key: Content key (e.g. Telegram file_unique_id) used to skip duplicates
+        check_duplicate: False if the caller already ran find_in_drive
+    
+    Returns:
+        The file ID if successful, None if failed
+    """
+    stream.seek(0)
+    return await _upload_media(
+        stream.read(), file_name, folder_id, credentials_path, dedup_key, check_duplicate
+    )
+
+
+async def get_file_link(file_id: str, credentials_path: str = "credentials.json") -> Optional[str]:
     """
     Get the web view link for a file.
     
     Args:
         file_id: The Google Drive file ID
         credentials_path: Path to OAuth credentials
-        
+    
     Returns:
         The web view link if successful, None if failed
     """
     try:
-        service = get_drive_service(credentials_path)
-        if service is None:
+        drive = await get_drive_service(credentials_path)
+        if drive is None:
             return None
-        file = service.files().get(
+        request = drive.files.get(
             fileId=file_id,
             fields='webViewLink'
-        ).execute()
+        )
+        file = await _send_with_retry(request)
         return file.get('webViewLink')
     except Exception as e:
         print(f"❌ Error getting file link: {str(e)}")
@@ -150,8 +425,8 @@ def authenticate():
     Call this once to set up OAuth token.
     """
     print("🔐 Starting OAuth authentication...")
-    service = get_drive_service()
-    if service:
+    creds = load_credentials()
+    if creds:
         print("✅ Authentication successful! Token saved.")
         return True
     return False
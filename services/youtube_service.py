@@ -4,91 +4,202 @@ Downloads YouTube videos and converts them to MP3 audio files.
 """
 
 import os
+import re
+import asyncio
 import yt_dlp
+from concurrent.futures import Executor
 from typing import Optional, Tuple
 
 
-def download_audio(youtube_url: str, output_dir: str = "downloads") -> Tuple[Optional[str], Optional[str]]:
+# Supported YouTube URL forms: watch, shorts, v, embed and youtu.be links
+_YT_RE = re.compile(r'(?:youtube\.com/(?:watch|shorts/|v/|embed/)|youtu\.be/)', re.IGNORECASE)
+
+# The 11-character video ID in each of those forms
+_VIDEO_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|v/|embed/)|youtu\.be/)([\w-]{11})',
+    re.IGNORECASE
+)
+
+# Characters not allowed in output filenames (keeps letters, digits, space, - and _)
+_SANITIZE_RE = re.compile(r'[^\w \-]+')
+
+
+def _find_ffmpeg() -> str:
+    """Locate the ffmpeg executable, falling back to the one on PATH."""
+    # FFmpeg path - try common locations
+    ffmpeg_paths = [
+        os.path.expandvars(r'%LOCALAPPDATA%\Microsoft\WinGet\Packages\Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe\ffmpeg-8.0.1-full_build\bin'),
+        os.path.expandvars(r'%LOCALAPPDATA%\Microsoft\WinGet\Links'),
+        r'C:\ffmpeg\bin',
+        r'C:\Program Files\ffmpeg\bin',
+    ]
+    for path in ffmpeg_paths:
+        if os.path.exists(os.path.join(path, 'ffmpeg.exe')):
+            return os.path.join(path, 'ffmpeg.exe')
+    return 'ffmpeg'
+
+
+# Resolved once at import instead of on every conversion
+FFMPEG_PATH = _find_ffmpeg()
+
+# Output MP3 bitrate, also used to estimate the file size before downloading
+AUDIO_BITRATE_KBPS = 192
+
+
+def probe_video(youtube_url: str) -> Tuple[Optional[str], Optional[float], Optional[float]]:
     """
-    Download audio from a YouTube video and convert to MP3.
+    Fetch video metadata without downloading anything.
     
     Args:
         youtube_url: The YouTube video URL
-        output_dir: Directory to save the audio file
         
     Returns:
-        Tuple of (file_path, title) if successful, (None, error_message) if failed
+        Tuple of (title, duration_seconds, approx_mp3_size_mb); values that
+        can't be determined (e.g. duration of a live stream) are None
     """
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': True,
+        # watch?v=...&list=... links would otherwise resolve to the playlist
+        'noplaylist': True,
+    }
     
-    # Configure yt-dlp options
-    # FFmpeg path - try common locations
-    import os as _os
-    ffmpeg_paths = [
-        _os.path.expandvars(r'%LOCALAPPDATA%\Microsoft\WinGet\Packages\Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe\ffmpeg-8.0.1-full_build\bin'),
-        _os.path.expandvars(r'%LOCALAPPDATA%\Microsoft\WinGet\Links'),
-        r'C:\ffmpeg\bin',
-        r'C:\Program Files\ffmpeg\bin',
-    ]
-    ffmpeg_location = None
-    for path in ffmpeg_paths:
-        if _os.path.exists(_os.path.join(path, 'ffmpeg.exe')):
-            ffmpeg_location = path
-            break
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(youtube_url, download=False)
+    except Exception:
+        return None, None, None
     
+    if info is None:
+        return None, None, None
+    
+    duration = info.get('duration')
+    # The MP3 is constant bitrate, so its size follows from the duration
+    approx_mb = duration * AUDIO_BITRATE_KBPS * 1000 / 8 / (1024 * 1024) if duration else None
+    return info.get('title'), duration, approx_mb
+
+
+def download_audio(youtube_url: str, output_dir: str = "downloads") -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Download the best audio stream of a YouTube video as-is (no conversion).
+    
+    Args:
+        youtube_url: The YouTube video URL
+        output_dir: Directory to save the audio file
+        
+    Returns:
+        Tuple of (file_path, title, video_id) if successful,
+        (None, error_message, None) if failed
+    """
+    # Configure yt-dlp options
+    # No postprocessor: conversion runs as a separate async ffmpeg process
     ydl_opts = {
         'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
         'quiet': True,
         'no_warnings': True,
+        'noplaylist': True,
     }
     
-    if ffmpeg_location:
-        ydl_opts['ffmpeg_location'] = ffmpeg_location
-    
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             # Extract video info
             info = ydl.extract_info(youtube_url, download=True)
             
             if info is None:
-                return None, "Failed to extract video information"
+                return None, "Failed to extract video information", None
             
-            # Get the title and construct the output filename
             title = info.get('title', 'audio')
-            # Clean the title for filename
-            safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
-            output_path = os.path.join(output_dir, f"{safe_title}.mp3")
             
-            # yt-dlp may create file with original title, find it
-            for file in os.listdir(output_dir):
-                if file.endswith('.mp3') and title[:20] in file:
-                    output_path = os.path.join(output_dir, file)
-                    break
+            # yt-dlp reports where it wrote the file; no directory scan needed
+            requested = info.get('requested_downloads') or [{}]
+            raw_path = requested[0].get('filepath') or ydl.prepare_filename(info)
             
-            if os.path.exists(output_path):
-                return output_path, title
+            if raw_path and os.path.exists(raw_path):
+                return raw_path, title, info.get('id')
             
-            # Try to find any newly created mp3 file
-            for file in os.listdir(output_dir):
-                if file.endswith('.mp3'):
-                    full_path = os.path.join(output_dir, file)
-                    # Check if this is a recently created file
-                    if os.path.getctime(full_path) > os.path.getctime(output_dir):
-                        return full_path, title
-            
-            return None, "Audio file not found after download"
+            return None, "Audio file not found after download", None
             
     except yt_dlp.DownloadError as e:
-        return None, f"Download error: {str(e)}"
+        return None, f"Download error: {str(e)}", None
     except Exception as e:
-        return None, f"Unexpected error: {str(e)}"
+        return None, f"Unexpected error: {str(e)}", None
+
+
+async def convert_to_mp3(source_path: str, output_path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Convert an audio file to MP3 with an async ffmpeg subprocess.
+    
+    Args:
+        source_path: Path to the downloaded audio file
+        output_path: Path of the MP3 file to create
+        
+    Returns:
+        Tuple of (file_path, None) if successful, (None, error_message) if failed
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, '-y', '-i', source_path,
+            '-vn', '-c:a', 'libmp3lame', '-b:a', f'{AUDIO_BITRATE_KBPS}k',
+            output_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+    except FileNotFoundError:
+        return None, "FFmpeg not found"
+    
+    if process.returncode != 0:
+        error = stderr.decode(errors='ignore').strip().splitlines()
+        return None, f"FFmpeg error: {error[-1] if error else process.returncode}"
+    
+    return output_path, None
+
+
+async def fetch_audio(
+    youtube_url: str,
+    output_dir: str = "downloads",
+    executor: Optional[Executor] = None
+) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Download audio from a YouTube video and convert to MP3.
+    
+    The download runs in the given executor and the conversion in an
+    ffmpeg subprocess, so the event loop stays free for other requests.
+    
+    Args:
+        youtube_url: The YouTube video URL
+        output_dir: Directory to save the audio file
+        executor: Executor for the download (a process pool avoids the GIL);
+            defaults to the loop's default executor
+        
+    Returns:
+        Tuple of (file_path, title, video_id) if successful,
+        (None, error_message, None) if failed
+    """
+    loop = asyncio.get_running_loop()
+    raw_path, title, video_id = await loop.run_in_executor(executor, download_audio, youtube_url, output_dir)
+    if raw_path is None:
+        return None, title, None
+    
+    # Clean the title for filename
+    safe_title = _SANITIZE_RE.sub('', title).strip()
+    output_path = os.path.join(output_dir, f"{safe_title or 'audio'}.mp3")
+    
+    try:
+        file_path, error = await convert_to_mp3(raw_path, output_path)
+    finally:
+        # The source stream is no longer needed once converted; remove it
+        # off the event loop like the rest of the blocking file I/O
+        try:
+            await asyncio.to_thread(os.remove, raw_path)
+        except OSError:
+            pass
+    
+    if file_path is None:
+        return None, error, None
+    return file_path, title, video_id
 
 
 def is_youtube_url(url: str) -> bool:
@@ -101,21 +212,28 @@ def is_youtube_url(url: str) -> bool:
     Returns:
         True if it's a YouTube URL, False otherwise
     """
-    youtube_patterns = [
-        'youtube.com/watch',
-        'youtu.be/',
-        'youtube.com/shorts/',
-        'youtube.com/v/',
-        'youtube.com/embed/',
-    ]
-    return any(pattern in url.lower() for pattern in youtube_patterns)
+    return _YT_RE.search(url) is not None
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """
+    Get the video ID from a YouTube URL without contacting YouTube.
+    
+    Args:
+        url: The YouTube video URL
+        
+    Returns:
+        The video ID, or None if the URL doesn't contain one
+    """
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
 
 
 if __name__ == "__main__":
     # Test the service
     test_url = input("Enter YouTube URL to test: ")
     if is_youtube_url(test_url):
-        result, title = download_audio(test_url)
+        result, title, _ = asyncio.run(fetch_audio(test_url))
         if result:
             print(f"✅ Downloaded: {result}")
             print(f"   Title: {title}")